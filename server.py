@@ -23,65 +23,357 @@ file as plain text with a suggested filename.
 """
 
 import argparse
+import asyncio
+import functools
 import io
+import os
+import sys
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from urllib.parse import quote
+
 from flask import Flask, request, Response
 
+try:
+    # ``httpx`` is optional; it lets the per-segment fallback run concurrently.
+    import httpx  # type: ignore
+    HAVE_HTTPX = True
+except ImportError:
+    HAVE_HTTPX = False
+
+try:
+    # ``waitress`` is optional; without it the Flask development server is used.
+    import waitress  # type: ignore
+    HAVE_WAITRESS = True
+except ImportError:
+    HAVE_WAITRESS = False
+
+try:
+    # HTTP/2 support in httpx needs the ``h2`` package.
+    import h2  # type: ignore  # noqa: F401
+    HAVE_HTTP2 = True
+except ImportError:
+    HAVE_HTTP2 = False
+
 # Import translation helpers from the CLI script
 # These functions are defined in translate_srt.py in the same directory.
 from translate_srt import (
+    TAG_REGEX,
+    cache_translation,
+    get_cached_translation,
     parse_srt,
-    translate_line_preserve_tags,
     get_offline_translator,
-    translate_via_api,
+    needs_translation,
+    parse_translation_response,
+    preserve_whitespace,
+    translate_via_api_batch,
+    try_translate_via_api,
 )
 
 app = Flask(__name__)
 
+# Default and maximum number of in-flight requests when segments are
+# translated one by one.  The maximum also bounds the httpx connection pool.
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 16
+
+# Joins the segments of one entry into a single translation call.  Argos
+# Translate (and LibreTranslate, which is built on it) translates each line
+# separately and keeps the line breaks, so the result splits back cleanly.
+SEGMENT_SEPARATOR = "\n"
+
+
+async def _translate_all_async(
+    parts: List[str],
+    source_lang: str,
+    target_lang: str,
+    api_url: str,
+    concurrency: int,
+) -> List[Optional[str]]:
+    """Translate segments with concurrent requests over a shared client.
+
+    Used when the API does not accept batched input.  At most
+    ``concurrency`` requests (capped at ``MAX_CONCURRENCY``) are in flight at
+    any time so that small self-hosted servers are not overwhelmed.
+
+    Returns:
+        One translation per segment, or ``None`` where the request failed.
+    """
+    concurrency = min(max(1, concurrency), MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(http2=HAVE_HTTP2, limits=limits, timeout=30) as client:
+
+        async def _one(text: str) -> Optional[str]:
+            params = {
+                "q": text,
+                "source": source_lang,
+                "target": target_lang,
+                "format": "text",
+            }
+            async with semaphore:
+                try:
+                    response = await client.post(api_url, data=params)
+                    response.raise_for_status()
+                    translated = parse_translation_response(response.json())
+                except Exception as exc:
+                    sys.stderr.write(f"[Warning] API translation failed: {exc}\n")
+                    return None
+            return translated
+
+        return list(await asyncio.gather(*[_one(p) for p in parts]))
+
+
+def translate_joined(
+    groups: List[List[str]], translate_many: Callable[[List[str]], List[str]]
+) -> List[List[str]]:
+    """Translate groups of segments with one translation call per group.
+
+    The segments of each group are joined with ``SEGMENT_SEPARATOR`` and
+    translated as a single string, then split back apart.  Groups whose
+    translation does not split into the original number of segments are
+    translated again one segment at a time.
+
+    Args:
+        groups: Lists of single‑line segments to translate together.
+        translate_many: Translates a list of strings, returning a list of
+            the same length.
+
+    Returns:
+        The translated segments, grouped like ``groups``.
+    """
+    joined = translate_many([SEGMENT_SEPARATOR.join(group) for group in groups])
+    results: List[List[str]] = []
+    retry: List[int] = []
+    for group, translated in zip(groups, joined):
+        parts = translated.split(SEGMENT_SEPARATOR)
+        if len(parts) != len(group):
+            retry.append(len(results))
+        results.append(parts)
+
+    if retry:
+        flat = iter(translate_many([text for i in retry for text in groups[i]]))
+        for i in retry:
+            results[i] = [next(flat) for _ in groups[i]]
+    return results
+
+
+def translate_segments(
+    groups: List[List[str]],
+    source_lang: str,
+    target_lang: str,
+    mode: str,
+    api_url: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[List[str]]:
+    """Translate plain‑text segments grouped by subtitle entry.
+
+    In API mode, segments already in the shared translation cache are
+    answered from it and the rest are sent to the service in a single
+    request.  If the service rejects the batch, each group is translated
+    with one call (see :func:`translate_joined`), with up to ``concurrency``
+    requests in flight when ``httpx`` is installed.
+
+    Returns:
+        The translated segments, grouped like ``groups``.
+    """
+    if mode == "offline":
+        translator_fn = get_offline_translator(source_lang, target_lang)
+        if translator_fn is not None:
+            translate_many = lambda texts: list(map(translator_fn, texts))
+            # One call per entry group.  Joining more segments per call would
+            # not batch the decoding: Argos splits its input on newlines and
+            # translates each line separately.
+            return translate_joined(groups, translate_many)
+        # Fallback to API if offline translator isn't available
+
+    # Segments translated by earlier requests are answered from the shared
+    # cache; only the rest are sent to the API.
+    translations: Dict[str, str] = {}
+    pending_groups: List[List[str]] = []
+    for group in groups:
+        pending: List[str] = []
+        for text in group:
+            cached = get_cached_translation(text, source_lang, target_lang, api_url)
+            if cached is None:
+                pending.append(text)
+            else:
+                translations[text] = cached
+        if pending:
+            pending_groups.append(pending)
+    if pending_groups:
+        translations.update(
+            _translate_api_groups(
+                pending_groups, source_lang, target_lang, api_url, concurrency
+            )
+        )
+    return [[translations[text] for text in group] for group in groups]
+
+
+def _translate_api_groups(
+    groups: List[List[str]],
+    source_lang: str,
+    target_lang: str,
+    api_url: str,
+    concurrency: int,
+) -> Dict[str, str]:
+    """Translate segment groups through the API and cache the results.
+
+    Returns:
+        A mapping from each segment to its translation.  Segments whose
+        request failed map to themselves and are not cached.
+    """
+    flat = [text for group in groups for text in group]
+    translated = translate_via_api_batch(flat, source_lang, target_lang, api_url)
+    if translated is not None:
+        for text, result in zip(flat, translated):
+            cache_translation(text, source_lang, target_lang, api_url, result)
+        return dict(zip(flat, translated))
+
+    fetch: Callable[[List[str]], List[Optional[str]]]
+    if HAVE_HTTPX:
+        fetch = lambda texts: asyncio.run(
+            _translate_all_async(texts, source_lang, target_lang, api_url, concurrency)
+        )
+    else:
+        translate_one = functools.partial(
+            try_translate_via_api, source=source_lang, target=target_lang, api_url=api_url
+        )
+        fetch = lambda texts: list(map(translate_one, texts))
+
+    # Strings whose request failed keep their original text and stay uncached
+    failed: Set[str] = set()
+
+    def translate_many(texts: List[str]) -> List[str]:
+        results: List[str] = []
+        for text, result in zip(texts, fetch(texts)):
+            if result is None:
+                failed.add(text)
+                result = text
+            results.append(result)
+        return results
+
+    translations: Dict[str, str] = {}
+    for group, translated_group in zip(groups, translate_joined(groups, translate_many)):
+        group_failed = SEGMENT_SEPARATOR.join(group) in failed
+        for text, result in zip(group, translated_group):
+            translations[text] = result
+            if not group_failed and text not in failed:
+                cache_translation(text, source_lang, target_lang, api_url, result)
+    return translations
 
-def translate_srt_content(
-    content: str,
+
+def translate_srt_to_entries(
+    content: Union[str, bytes],
     source_lang: str,
     target_lang: str,
     mode: str = "offline",
     api_url: str = "https://translate.argosopentech.com/translate",
-) -> str:
-    """Translate the contents of an SRT file.
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[List[str]]:
+    """Translate the contents of an SRT file into a list of entries.
 
     Args:
-        content: The raw contents of the .srt file as a string.
+        content: The raw contents of the .srt file, as a string or as
+            UTF‑8 encoded bytes.
         source_lang: ISO 639‑1 code of the source language (e.g. ``"en"``).
         target_lang: ISO 639‑1 code of the target language (e.g. ``"nb"``).
         mode: ``"offline"`` to use Argos Translate or ``"api"`` to use
             a LibreTranslate‑compatible HTTP service.
         api_url: URL of the translation API when in API mode.
+        concurrency: Maximum number of parallel requests when the API does
+            not support batched translation.
 
     Returns:
-        A string containing the translated subtitle file.
+        The translated entries, each a list of lines as produced by
+        :func:`parse_srt`.
     """
     entries = parse_srt(content)
 
-    # Determine translation function based on mode
-    if mode == "offline":
-        translator_fn = get_offline_translator(source_lang, target_lang)
-        # Fallback to API if offline translator isn't available
-        if translator_fn is None:
-            translator_fn = lambda txt: translate_via_api(txt, source_lang, target_lang, api_url)
-    else:
-        translator_fn = lambda txt: translate_via_api(txt, source_lang, target_lang, api_url)
+    # Pass 1: split every dialogue line around its markup tags and record
+    # where each translatable segment lives so it can be spliced back later.
+    # Distinct segments are grouped by the entry they first appear in.
+    split_lines: List[List[List[str]]] = []
+    slots: List[Tuple[int, int, int]] = []
+    texts: List[str] = []
+    groups: List[List[str]] = []
+    seen: Set[str] = set()
+    split_tags = TAG_REGEX.split  # bound once for the loop below
+    for entry_idx, entry in enumerate(entries):
+        entry_parts: List[List[str]] = []
+        group: List[str] = []
+        for line_idx, line in enumerate(entry[2:]):
+            parts = split_tags(line)
+            # Tags sit at the odd indices; only the even ones need translating
+            for part_idx in range(0, len(parts), 2):
+                part = parts[part_idx]
+                if not needs_translation(part):
+                    continue
+                slots.append((entry_idx, line_idx, part_idx))
+                # Surrounding whitespace is restored after translation, so
+                # segments differing only in spacing share one translation.
+                text = part.strip()
+                texts.append(text)
+                if text not in seen:
+                    seen.add(text)
+                    group.append(text)
+            entry_parts.append(parts)
+        split_lines.append(entry_parts)
+        if group:
+            groups.append(group)
+
+    # Pass 2: translate each distinct segment once and splice the results back.
+    translated_groups = translate_segments(
+        groups, source_lang, target_lang, mode, api_url, concurrency
+    )
+    translations: Dict[str, str] = {}
+    for group, translated_group in zip(groups, translated_groups):
+        translations.update(zip(group, translated_group))
+    for (entry_idx, line_idx, part_idx), text in zip(slots, texts):
+        parts = split_lines[entry_idx][line_idx]
+        parts[part_idx] = preserve_whitespace(parts[part_idx], translations[text])
 
-    output_lines = []
-    for entry in entries:
+    translated_entries: List[List[str]] = []
+    for entry, entry_parts in zip(entries, split_lines):
         # First two lines are index and timing
-        output_lines.append(entry[0])
-        if len(entry) > 1:
-            output_lines.append(entry[1])
-        # Translate any dialogue lines (from the third line onwards)
-        for line in entry[2:]:
-            output_lines.append(translate_line_preserve_tags(line, translator_fn))
+        output_lines = entry[:2]
+        # Dialogue lines (from the third line onwards) are now translated
+        output_lines.extend("".join(parts) for parts in entry_parts)
+        translated_entries.append(output_lines)
+    return translated_entries
+
+
+def iter_srt_text(entries: List[List[str]]) -> Iterator[str]:
+    """Yield the text form of an SRT file one entry at a time."""
+    for entry_idx, entry in enumerate(entries):
         # Separate entries with a blank line
-        output_lines.append("")
+        separator = "\n" if entry_idx else ""
+        yield separator + "\n".join(entry) + "\n"
 
-    return "\n".join(output_lines)
+
+def content_disposition(filename: str) -> str:
+    """Build an attachment ``Content-Disposition`` value for ``filename``.
+
+    The name is sent percent‑encoded in ``filename*`` (RFC 5987) so spaces and
+    non‑ASCII characters survive, with a plain ASCII ``filename`` for clients
+    that do not understand the extended form.
+    """
+    fallback = "".join(
+        ch if ch.isascii() and ch.isprintable() and ch not in '"\\' else "_"
+        for ch in filename
+    )
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+def gzip_chunks(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Gzip‑compress a stream of text chunks as UTF‑8, yielding compressed bytes."""
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 @app.route("/translate-srt", methods=["POST"])
@@ -98,32 +390,48 @@ def translate_srt_endpoint() -> Response:
         "api_url",
         "https://translate.argosopentech.com/translate",
     )
+    concurrency = min(
+        max(1, request.form.get("concurrency", DEFAULT_CONCURRENCY, type=int)),
+        MAX_CONCURRENCY,
+    )
+
+    # Pass the raw bytes on; the parser decodes each entry as it splits them,
+    # falling back from UTF-8 to Windows-1252/Latin-1 for legacy files.
+    content = uploaded_file.read()
 
-    # Read the uploaded file into memory (decode using UTF-8 with fallback)
-    raw_data = uploaded_file.read()
-    try:
-        content = raw_data.decode("utf-8")
-    except UnicodeDecodeError:
-        # Try Latin-1 if UTF-8 fails
-        content = raw_data.decode("latin-1")
-
-    # Translate the subtitle content
-    translated_content = translate_srt_content(
-        content, source_lang, target_lang, mode=mode, api_url=api_url
+    # Translate the subtitle content before responding, so that a failure
+    # still produces an error status instead of a truncated 200 response.
+    translated_entries = translate_srt_to_entries(
+        content,
+        source_lang,
+        target_lang,
+        mode=mode,
+        api_url=api_url,
+        concurrency=concurrency,
     )
+    # Only the formatting of the finished entries is streamed
+    translated_chunks = iter_srt_text(translated_entries)
 
     # Construct filename: original basename + target language code
     original_name = uploaded_file.filename or "subtitle.srt"
-    base = original_name.rsplit(".", 1)[0]
+    base = os.path.splitext(original_name)[0]
     translated_filename = f"{base}.{target_lang}.srt"
 
+    headers = {
+        "Content-Disposition": content_disposition(translated_filename),
+        "Vary": "Accept-Encoding",
+    }
+    # Subtitle text compresses well, so gzip it for clients that accept it
+    body: Iterable = translated_chunks
+    if request.accept_encodings["gzip"]:
+        body = gzip_chunks(translated_chunks)
+        headers["Content-Encoding"] = "gzip"
+
     # Return as plain text with a Content-Disposition header
     return Response(
-        translated_content,
+        body,
         mimetype="text/plain; charset=utf-8",
-        headers={
-            "Content-Disposition": f"attachment; filename={translated_filename}",
-        },
+        headers=headers,
     )
 
 
@@ -134,9 +442,17 @@ def main() -> None:
     parser.add_argument(
         "--debug", action="store_true", help="Enable Flask debug mode"
     )
+    parser.add_argument(
+        "--threads", default=16, type=int, help="Worker threads when served by waitress"
+    )
     args = parser.parse_args()
 
-    app.run(host=args.host, port=args.port, debug=args.debug)
+    # Prefer the production waitress server; the Flask development server
+    # is only used for debugging or when waitress is not installed.
+    if HAVE_WAITRESS and not args.debug:
+        waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
 
 
 if __name__ == "__main__":
@@ -54,13 +54,18 @@ Author: NorTrans project
 """
 
 import argparse
+import codecs
+import functools
+import io
 import json
 import os
 import re
 import sys
+import threading
 import urllib.parse
 import urllib.request
-from typing import Callable, List
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, TextIO, Tuple, Union
 
 try:
     # ``requests`` is optional; use standard library if not available.
@@ -69,6 +74,139 @@ try:
 except ImportError:
     HAVE_REQUESTS = False
 
+if HAVE_REQUESTS:
+    # One shared session keeps connections to the translation API alive, so
+    # only the first request pays for the TCP and TLS handshakes.  The
+    # Content-Type is left to each request since form and JSON bodies are sent.
+    _SESSION = requests.Session()
+    _SESSION.headers["Connection"] = "keep-alive"
+
+
+def _post_form_requests(url: str, params: Dict[str, str], timeout: float) -> bytes:
+    """POST urlencoded form data through the shared ``requests`` session."""
+    response = _SESSION.post(url, data=params, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def _post_json_requests(url: str, payload: dict, timeout: float) -> bytes:
+    """POST a JSON body through the shared ``requests`` session."""
+    response = _SESSION.post(url, json=payload, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def _post_form_urllib(url: str, params: Dict[str, str], timeout: float) -> bytes:
+    """POST urlencoded form data using only the standard library."""
+    data = urllib.parse.urlencode(params).encode("utf-8")
+    return _post_urllib(url, data, "application/x-www-form-urlencoded", timeout)
+
+
+def _post_json_urllib(url: str, payload: dict, timeout: float) -> bytes:
+    """POST a JSON body using only the standard library."""
+    data = json.dumps(payload).encode("utf-8")
+    return _post_urllib(url, data, "application/json", timeout)
+
+
+def _post_urllib(url: str, data: bytes, content_type: str, timeout: float) -> bytes:
+    """Send an encoded request body with ``urllib`` and return the response body."""
+    headers = {
+        "Content-Type": content_type,
+    }
+    request = urllib.request.Request(url, data=data, headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+# The HTTP backend is chosen once at import time.  Both variants return the
+# raw response body and raise on network or HTTP errors.
+_POST_FORM = _post_form_requests if HAVE_REQUESTS else _post_form_urllib
+_POST_JSON = _post_json_requests if HAVE_REQUESTS else _post_json_urllib
+
+
+# Maximum number of distinct segments remembered by the API translation cache.
+API_CACHE_SIZE = 8192
+
+# Per-segment API translations shared by every caller in the process, keyed by
+# ``(text, source, target, api_url)``.  The least recently used entry is
+# evicted once the cache holds ``API_CACHE_SIZE`` segments.
+_API_CACHE: "OrderedDict[Tuple[str, str, str, str], str]" = OrderedDict()
+_API_CACHE_LOCK = threading.Lock()
+
+
+def get_cached_translation(text: str, source: str, target: str, api_url: str) -> Optional[str]:
+    """Return the cached API translation of ``text``, or ``None`` if unknown."""
+    key = (text, source, target, api_url)
+    with _API_CACHE_LOCK:
+        translated = _API_CACHE.get(key)
+        if translated is not None:
+            _API_CACHE.move_to_end(key)
+    return translated
+
+
+def cache_translation(text: str, source: str, target: str, api_url: str, translated: str) -> None:
+    """Remember a successful API translation of ``text``.
+
+    Only call this with real translations; failed requests must not be
+    cached, so that they are retried on the next call.
+    """
+    key = (text, source, target, api_url)
+    with _API_CACHE_LOCK:
+        _API_CACHE[key] = translated
+        _API_CACHE.move_to_end(key)
+        if len(_API_CACHE) > API_CACHE_SIZE:
+            _API_CACHE.popitem(last=False)
+
+
+def _request_translation(text: str, source: str, target: str, api_url: str) -> str:
+    """Send a single translation request and return the parsed result.
+
+    Network errors, non‑JSON bodies and responses without a translation are
+    raised rather than returned.
+    """
+    # Prepare the data payload.  LibreTranslate accepts application/x-www-form-urlencoded
+    # or JSON bodies.  For maximum compatibility we send urlencoded form data.
+    params = {
+        "q": text,
+        "source": source,
+        "target": target,
+        "format": "text",
+    }
+    resp_data = _POST_FORM(api_url, params, 30).decode("utf-8")
+    translated = parse_translation_response(json.loads(resp_data))
+    if translated is None:
+        raise ValueError(f"API response contains no translation: {resp_data!r}")
+    return translated
+
+
+def try_translate_via_api(text: str, source: str, target: str, api_url: str) -> Optional[str]:
+    """Translate a string like :func:`translate_via_api`, but report failure.
+
+    Returns:
+        The translated text with the leading and trailing whitespace of
+        ``text`` preserved, or ``None`` if the request failed.  Whitespace‑only
+        input is returned unchanged.
+    """
+    # Short‑circuit empty strings to avoid unnecessary network calls.
+    stripped = text.strip()
+    if not stripped:
+        return text
+
+    # Repeated phrases are only sent once per process.
+    translated = get_cached_translation(stripped, source, target, api_url)
+    if translated is None:
+        try:
+            translated = _request_translation(stripped, source, target, api_url)
+        except json.JSONDecodeError as exc:
+            sys.stderr.write(f"[Warning] API returned non‑JSON response: {exc.doc!r}\n")
+            return None
+        except Exception as exc:
+            sys.stderr.write(f"[Warning] API translation failed: {exc}\n")
+            return None
+        cache_translation(stripped, source, target, api_url, translated)
+
+    return preserve_whitespace(text, translated)
+
 
 def translate_via_api(text: str, source: str, target: str, api_url: str) -> str:
     """Translate a string using a LibreTranslate compatible HTTP API.
@@ -80,59 +218,127 @@ def translate_via_api(text: str, source: str, target: str, api_url: str) -> str:
         api_url: Base URL of the translation endpoint (e.g. ``/translate``).
 
     Returns:
-        The translated text returned by the API.  If the API returns an
-        unexpected response format, the original text is returned.
+        The translated text returned by the API, with the leading and trailing
+        whitespace of ``text`` preserved.  If the request fails or the API
+        returns an unexpected response format, the original text is returned.
     """
-    # Short‑circuit empty strings to avoid unnecessary network calls.
-    if not text.strip():
-        return text
+    translated = try_translate_via_api(text, source, target, api_url)
+    # Unexpected response; return original text
+    return text if translated is None else translated
 
-    # Prepare the data payload.  LibreTranslate accepts application/x-www-form-urlencoded
-    # or JSON bodies.  For maximum compatibility we send urlencoded form data.
-    params = {
-        "q": text,
+
+def preserve_whitespace(original: str, translated: str) -> str:
+    """Re-apply the leading and trailing whitespace of ``original`` to ``translated``."""
+    leading = original[: len(original) - len(original.lstrip())]
+    trailing = original[len(original.rstrip()):]
+    return leading + translated.strip() + trailing
+
+
+# LibreTranslate returns {"translatedText": ...}.  Other services may use
+# different keys, so several possibilities are tried in order.
+TRANSLATION_KEYS = ("translatedText", "translation", "translated_text", "translated")
+
+
+def _translation_value(json_resp):
+    """Return the raw translation from a decoded API response.
+
+    Dicts are searched for ``TRANSLATION_KEYS`` and yield ``None`` if none is
+    present; any other response is returned as is.
+    """
+    if isinstance(json_resp, dict):
+        for key in TRANSLATION_KEYS:
+            if key in json_resp:
+                return json_resp[key]
+        return None
+    return json_resp
+
+
+def parse_translation_response(json_resp) -> Optional[str]:
+    """Extract the translated string from a decoded API response.
+
+    Returns ``None`` if the response does not contain a translation.
+    """
+    translated = _translation_value(json_resp)
+    if isinstance(json_resp, dict) and translated is not None:
+        return str(translated)
+    # If response is just a string, return it.
+    if isinstance(translated, str):
+        return translated
+    return None
+
+
+def translate_via_api_batch(
+    texts: List[str], source: str, target: str, api_url: str
+) -> Optional[List[str]]:
+    """Translate several strings with a single LibreTranslate request.
+
+    LibreTranslate accepts a JSON array for ``q`` and answers with an array of
+    translations in the same order, so a whole subtitle file can be sent in
+    one round‑trip instead of one request per line.
+
+    Args:
+        texts: The input strings to translate.
+        source: ISO 639‑1 code of the source language.
+        target: ISO 639‑1 code of the target language.
+        api_url: Base URL of the translation endpoint (e.g. ``/translate``).
+
+    Returns:
+        A list with one translation per input string, or ``None`` if the
+        request failed or the service does not support array input.  Callers
+        should fall back to per‑string translation in that case.
+    """
+    if not texts:
+        return []
+
+    payload = {
+        "q": texts,
         "source": source,
         "target": target,
         "format": "text",
     }
-    data = urllib.parse.urlencode(params).encode("utf-8")
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-
     try:
-        request = urllib.request.Request(api_url, data=data, headers=headers)
-        with urllib.request.urlopen(request, timeout=30) as response:
-            resp_data = response.read().decode("utf-8")
+        json_resp = json.loads(_POST_JSON(api_url, payload, 300).decode("utf-8"))
     except Exception as exc:
-        sys.stderr.write(f"[Warning] API translation failed: {exc}\n")
-        return text
+        sys.stderr.write(f"[Warning] Batch API translation failed: {exc}\n")
+        return None
 
-    try:
-        json_resp = json.loads(resp_data)
-    except json.JSONDecodeError:
-        # Unexpected response; return original text
-        sys.stderr.write(f"[Warning] API returned non‑JSON response: {resp_data!r}\n")
-        return text
+    translated = _translation_value(json_resp)
+    # Services without array support either echo a single string or
+    # return a list of a different length; neither can be spliced back.
+    if not isinstance(translated, list) or len(translated) != len(texts):
+        return None
+    return [str(item) for item in translated]
 
-    # LibreTranslate returns {"translatedText": "..."}.  Other services may use
-    # different keys.  Try several possibilities before falling back to original.
-    for key in ("translatedText", "translation", "translated_text", "translated"):
-        if isinstance(json_resp, dict) and key in json_resp:
-            return str(json_resp[key])
-    # If response is just a string, return it.
-    if isinstance(json_resp, str):
-        return json_resp
-    return text
+
+# Offline translators resolved so far, keyed by ``(source, target)``.
+_OFFLINE_CACHE: Dict[Tuple[str, str], Callable[[str], str]] = {}
+_OFFLINE_CACHE_LOCK = threading.Lock()
 
 
-def get_offline_translator(source: str, target: str):
+def get_offline_translator(source: str, target: str) -> Optional[Callable[[str], str]]:
     """Attempt to create an offline translator using Argos Translate.
 
     Returns a callable that takes a string and returns its translation.  If
     Argos Translate is not installed or the model for the requested language
-    pair is missing, returns ``None``.
+    pair is missing, returns ``None``.  Resolved translators are cached for
+    the lifetime of the process.
     """
+    translator_fn = _OFFLINE_CACHE.get((source, target))
+    if translator_fn is not None:
+        return translator_fn
+
+    # Only one thread loads a given model; the others wait and reuse it.
+    with _OFFLINE_CACHE_LOCK:
+        translator_fn = _OFFLINE_CACHE.get((source, target))
+        if translator_fn is None:
+            translator_fn = _load_offline_translator(source, target)
+            if translator_fn is not None:
+                _OFFLINE_CACHE[(source, target)] = translator_fn
+    return translator_fn
+
+
+def _load_offline_translator(source: str, target: str) -> Optional[Callable[[str], str]]:
+    """Resolve the Argos Translate translation for a language pair."""
     try:
         import argostranslate.package
         import argostranslate.translate
@@ -150,14 +356,47 @@ def get_offline_translator(source: str, target: str):
     return translator.translate
 
 
-def parse_srt(content: str) -> List[List[str]]:
+# Encodings tried, in order, for each entry of an uploaded SRT file.  Older
+# subtitles are often Windows-1252 or Latin-1 rather than UTF-8.
+SRT_ENCODINGS = ("utf-8", "cp1252", "latin-1")
+
+
+def _decode_srt_block(raw: bytes) -> str:
+    """Decode one SRT entry with the first encoding in ``SRT_ENCODINGS`` that fits."""
+    for encoding in SRT_ENCODINGS:
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    # Only reached if the list no longer ends with Latin-1, which never fails
+    return raw.decode("utf-8", errors="replace")
+
+
+def parse_srt(content: Union[str, bytes]) -> List[List[str]]:
     """Parse the contents of an SRT file into a list of entries.
 
     Each entry is a list of lines including the index, time span and one or
     more text lines.  Blank lines between entries are not preserved.
+
+    ``content`` may also be the raw bytes of the file.  The entries are then
+    split apart on the bytes and decoded one at a time (see
+    :func:`_decode_srt_block`), so the whole file is never decoded in one
+    piece.
     """
-    # Normalize line endings
-    content = content.replace("\r\n", "\n").replace("\r", "\n")
+    if isinstance(content, bytes):
+        if content.startswith(codecs.BOM_UTF8):
+            content = content[len(codecs.BOM_UTF8):]
+        if b"\r" in content:
+            content = content.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        return [
+            _decode_srt_block(raw).split("\n")
+            for raw in content.strip().split(b"\n\n")
+        ]
+
+    # Normalize line endings.  Files that already use ``\n`` skip both
+    # full-buffer copies.
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
     entries_raw = content.strip().split("\n\n")
     entries: List[List[str]] = []
     for raw in entries_raw:
@@ -169,6 +408,15 @@ def parse_srt(content: str) -> List[List[str]]:
 
 TAG_REGEX = re.compile(r"(<[^>]+>)")
 
+# Text without any letters (numbers, punctuation, music notes, whitespace)
+# cannot be improved by translation and is left untouched.
+UNTRANSLATABLE_REGEX = re.compile(r"[\W\d_]*")
+
+
+def needs_translation(text: str) -> bool:
+    """Return ``True`` if ``text`` contains anything worth translating."""
+    return UNTRANSLATABLE_REGEX.fullmatch(text) is None
+
 
 def translate_line_preserve_tags(line: str, translate_fn: Callable[[str], str]) -> str:
     """Translate a single line while preserving HTML/markup tags.
@@ -180,20 +428,13 @@ def translate_line_preserve_tags(line: str, translate_fn: Callable[[str], str])
     Returns:
         The translated line with tags left in place.
     """
+    # ``TAG_REGEX`` has a single capturing group, so ``split`` always places
+    # the tags at odd indices and the plain text at even indices.
     parts = TAG_REGEX.split(line)
-    translated_parts: List[str] = []
-    for part in parts:
-        # If the part matches the tag regex, leave it unchanged
-        if TAG_REGEX.fullmatch(part):
-            translated_parts.append(part)
-        else:
-            # Otherwise translate the plain text; preserve whitespace
-            if part.strip():
-                translated = translate_fn(part)
-            else:
-                translated = part
-            translated_parts.append(translated)
-    return "".join(translated_parts)
+    return "".join(
+        translate_fn(part) if not i & 1 and needs_translation(part) else part
+        for i, part in enumerate(parts)
+    )
 
 
 def translate_srt_entries(entries: List[List[str]], translate_fn: Callable[[str], str]) -> List[List[str]]:
@@ -224,9 +465,24 @@ def translate_srt_entries(entries: List[List[str]], translate_fn: Callable[[str]
     return translated_entries
 
 
+def write_srt_entries(entries: List[List[str]], out: TextIO) -> None:
+    """Write SRT entries to a text stream in the text form of an SRT file.
+
+    Entries are written one at a time, so the complete file is never held
+    in memory as a single string.
+    """
+    for entry_idx, entry in enumerate(entries):
+        if entry_idx:
+            out.write("\n\n")
+        out.write("\n".join(entry))
+    out.write("\n")
+
+
 def srt_entries_to_string(entries: List[List[str]]) -> str:
     """Convert a list of SRT entries back into the text form of an SRT file."""
-    return "\n\n".join("\n".join(entry) for entry in entries) + "\n"
+    buf = io.StringIO()
+    write_srt_entries(entries, buf)
+    return buf.getvalue()
 
 
 def main() -> None:
@@ -245,19 +501,22 @@ def main() -> None:
         sys.stderr.write(f"Error: input file '{args.input}' does not exist\n")
         sys.exit(1)
 
-    # Decide which translation function to use
-    translate_fn: Callable[[str], str]
+    # Decide which translation function to use.  The language pair and URL
+    # are bound once up front so each call only passes the text.
+    api_translate_fn = functools.partial(
+        translate_via_api,
+        source=args.source_lang,
+        target=args.target_lang,
+        api_url=args.api_url,
+    )
+    translate_fn: Callable[[str], str] = api_translate_fn
     if args.mode == "offline":
         offline_translator = get_offline_translator(args.source_lang, args.target_lang)
         if offline_translator is None:
             sys.stderr.write("[Warning] Offline mode requested but Argos Translate is not configured. "
                              "Falling back to API mode.\n")
         else:
-            translate_fn = lambda text: offline_translator(text)
-        if offline_translator is None:
-            translate_fn = lambda text: translate_via_api(text, args.source_lang, args.target_lang, args.api_url)
-    else:
-        translate_fn = lambda text: translate_via_api(text, args.source_lang, args.target_lang, args.api_url)
+            translate_fn = offline_translator
 
     # Read and parse the input file
     with open(args.input, "r", encoding="utf-8-sig") as f:
@@ -269,7 +528,7 @@ def main() -> None:
 
     # Write output file
     with open(args.output, "w", encoding="utf-8") as f:
-        f.write(srt_entries_to_string(translated_entries))
+        write_srt_entries(translated_entries, f)
     print(f"Translation complete. Output written to {args.output}")
 
 